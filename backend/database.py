@@ -1,47 +1,108 @@
+import asyncio
 import os
-import re
-from sqlalchemy import create_engine, text
+from uuid import uuid4
+from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
-import json
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+import orjson
 
 DB_USER = os.getenv("DB_USER", "imoscow_admin")
 DB_PASS = os.getenv("DB_PASS", "pudge")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "imoscow_test")
+# Behind PgBouncer (transaction pooling) keep the per-worker pool small.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
 
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
 try:
-    engine = create_engine(DATABASE_URL)
-    with engine.connect() as connection:
-        print("Database connection established successfully.")
+    # asyncpg connections are bound to the event loop, so the engine only
+    # creates the pool here; connections are opened on the serving loop.
+    engine = create_async_engine(
+        DATABASE_URL,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=30,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        # JSONB columns (wer) are decoded with orjson instead of the json module.
+        json_serializer=lambda obj: orjson.dumps(obj).decode(),
+        json_deserializer=orjson.loads,
+        # PgBouncer in transaction mode hands each transaction a different
+        # server connection, so asyncpg must not reuse named prepared
+        # statements across them.
+        connect_args={
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__"
+        }
+    )
 except Exception as e:
-    print(f"Failed to connect to the database: {e}")
+    print(f"Failed to create the database engine: {e}")
     engine = None
 
-def execute_query(query, params=None):
+async def warm_up_pool():
+    if not engine:
+        print("Database engine is not available, skipping pool warm-up.")
+        return
+    connections = await asyncio.gather(
+        *(engine.connect().start() for _ in range(DB_POOL_SIZE)),
+        return_exceptions=True
+    )
+    opened = [c for c in connections if not isinstance(c, BaseException)]
+    # Returning the connections leaves them idle in the pool for the first requests.
+    for connection in opened:
+        await connection.close()
+    if len(opened) == len(connections):
+        print("Database connection established successfully.")
+    else:
+        failed = next(c for c in connections if isinstance(c, BaseException))
+        print(f"Failed to connect to the database: {failed}")
+
+async def dispose_engine():
+    if engine:
+        await engine.dispose()
+
+async def execute_query(query, params=None):
     if not engine:
         raise ConnectionError("Database engine is not available.")
     try:
-        with engine.connect() as connection:
-            result = connection.execute(text(query), params or {})
-            connection.commit()
-            return result
+        async with engine.begin() as connection:
+            return await connection.execute(text(query), params or {})
     except SQLAlchemyError as e:
         print(f"Database query failed: {e}")
         return None
 
-def get_all_files():
+async def get_all_files():
     query = "SELECT file_id, file_path, file_name, file_extension, load_date FROM files"
-    result = execute_query(query)
+    result = await execute_query(query)
     if result:
         return [dict(row._mapping) for row in result]
     return []
 
+async def get_all_files_with_latest_wer() -> list[dict]:
+    query = """
+        SELECT f.file_id, f.file_name, t.wer, t.transcript_id IS NOT NULL AS recognized
+        FROM files f
+        LEFT JOIN LATERAL (
+            SELECT transcript_id, wer
+            FROM file_transcripts
+            WHERE file_id = f.file_id
+            ORDER BY created_at DESC
+            LIMIT 1
+        ) t ON TRUE
+        ORDER BY f.file_id;
+    """
+    result = await execute_query(query)
+    return [dict(row._mapping) for row in result] if result else []
 
-def save_file_record(file_path: str, file_name: str, file_extension: str) -> dict | None:
-    if not re.match(r'^[a-zA-Z0-9]+$', file_extension):
+
+async def save_file_record(file_path: str, file_name: str, file_extension: str) -> dict | None:
+    if not (file_extension.isascii() and file_extension.isalnum()):
         raise ValueError("Invalid file extension: only alphanumeric characters are allowed.")
 
     query = """
@@ -55,16 +116,42 @@ def save_file_record(file_path: str, file_name: str, file_extension: str) -> dic
         "file_extension": file_extension
     }
     
-    result = execute_query(query, params)
+    result = await execute_query(query, params)
     if result:
-        row = result.first()
+        row = result.one_or_none()
         if row:
             return {"file_id": row.file_id, "load_date": row.load_date}
     return None
 
-def get_file_record(file_id: int) -> dict | None:
+async def save_file_records(records: list[dict]) -> list[dict]:
+    # One round-trip for the whole batch: the columns travel as three arrays.
+    for record in records:
+        extension = record["file_extension"]
+        if not (extension.isascii() and extension.isalnum()):
+            raise ValueError("Invalid file extension: only alphanumeric characters are allowed.")
+
+    query = """
+        INSERT INTO files (file_path, file_name, file_extension)
+        SELECT * FROM unnest(CAST(:file_paths AS text[]), CAST(:file_names AS text[]), CAST(:file_extensions AS text[]))
+        RETURNING file_id, file_path, load_date;
+    """
+    params = {
+        "file_paths": [record["file_path"] for record in records],
+        "file_names": [record["file_name"] for record in records],
+        "file_extensions": [record["file_extension"] for record in records]
+    }
+
+    result = await execute_query(query, params)
+    if result:
+        # Neither ids nor RETURNING rows are guaranteed to follow the input
+        # order, so rows are matched back to the records by their path.
+        rows = {row.file_path: {"file_id": row.file_id, "load_date": row.load_date} for row in result}
+        return [rows[record["file_path"]] for record in records if record["file_path"] in rows]
+    return []
+
+async def get_file_record(file_id: int) -> dict | None:
     query = "SELECT file_id, file_path, file_name, file_extension, load_date FROM files WHERE file_id = :file_id;"
-    result = execute_query(query, {"file_id": file_id})
+    result = await execute_query(query, {"file_id": file_id})
     if result:
         row = result.first()
         if row:
@@ -72,14 +159,14 @@ def get_file_record(file_id: int) -> dict | None:
     return None
 
 
-def save_transcript_record(file_id: int, transcript_path: str, wer: dict) -> int | None:
+async def save_transcript_record(file_id: int, transcript_path: str, wer: dict) -> int | None:
     query = """
         INSERT INTO file_transcripts (file_id, transcript_path, wer)
         VALUES (:file_id, :transcript_path, :wer)
         RETURNING transcript_id;
     """
     # Convert dict to JSON string for the database
-    wer_json = json.dumps(wer)
+    wer_json = orjson.dumps(wer).decode()
     
     params = {
         "file_id": file_id,
@@ -87,19 +174,19 @@ def save_transcript_record(file_id: int, transcript_path: str, wer: dict) -> int
         "wer": wer_json
     }
 
-    result = execute_query(query, params)
+    result = await execute_query(query, params)
     return result.scalar_one_or_none() if result else None
 
-def get_transcript_record(transcript_id: int) -> dict | None:
+async def get_transcript_record(transcript_id: int) -> dict | None:
     query = "SELECT transcript_id, file_id, transcript_path, wer FROM file_transcripts WHERE transcript_id = :transcript_id;"
-    result = execute_query(query, {"transcript_id": transcript_id})
+    result = await execute_query(query, {"transcript_id": transcript_id})
     if result:
         row = result.first()
         if row:
             return dict(row._mapping)
     return None
 
-def get_transcripts_for_file(file_id: int) -> list[dict]:
-    query = "SELECT transcript_id, transcript_path, wer, created_at FROM file_transcripts WHERE file_id = :file_id;"
-    result = execute_query(query, {"file_id": file_id})
+async def get_transcripts_for_file(file_id: int) -> list[dict]:
+    query = "SELECT transcript_id, transcript_path, wer, created_at FROM file_transcripts WHERE file_id = :file_id ORDER BY created_at DESC;"
+    result = await execute_query(query, {"file_id": file_id})
     return [dict(row._mapping) for row in result] if result else []
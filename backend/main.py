@@ -1,44 +1,73 @@
+import asyncio
+import aiofiles
 import io
-import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
-from fastapi import FastAPI, File, UploadFile, HTTPException, Path as FastApiPath
-from fastapi.responses import JSONResponse
+from urllib.parse import quote
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request, Path as FastApiPath
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, Response
 from pydantic import BaseModel
 import uvicorn
-from ocr import recognize_text_from_file
+from ocr import get_ocr_model, recognize_text_from_file
 import random
 
-from utils import save_upload_file
+from utils import ORJSONResponse, save_upload_file
 
 from database import (
+    warm_up_pool,
+    dispose_engine,
     save_file_record,
+    save_file_records,
     get_file_record,
     save_transcript_record,
     get_transcript_record,
     get_transcripts_for_file,
-    get_all_files
+    get_all_files_with_latest_wer
 )
 
+# OCR is CPU/GPU bound and takes seconds per page, so it runs outside the
+# event loop on a small dedicated pool that bounds concurrent recognitions.
+# These threads mostly wait on the preprocessing pool and the line batcher;
+# with more than one, lines of concurrent requests share model batches.
+OCR_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("OCR_WORKERS", "4")), thread_name_prefix="ocr")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await warm_up_pool()
+    # Load the TrOCR weights once per worker before accepting requests.
+    await asyncio.get_running_loop().run_in_executor(OCR_EXECUTOR, get_ocr_model)
+    yield
+    OCR_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    await dispose_engine()
+
 app = FastAPI(
     title="Modular Document Transcription API",
     description="API for uploading files and managing their text transcripts.",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
-UPLOAD_DIR = Path("~/data")
+UPLOAD_DIR = Path(os.path.expanduser("~/data")).resolve()
 TRANSCRIPT_DIR = UPLOAD_DIR / "transcripts"
 TRANSCRIPT_DIR.mkdir(parents=True, exist_ok=True)
+# When set (e.g. "/internal/transcripts"), downloads are handed to nginx via X-Accel-Redirect.
+TRANSCRIPT_ACCEL_PREFIX = os.getenv("TRANSCRIPT_ACCEL_PREFIX", "").rstrip("/")
 
 
 @app.post("/files/upload", summary="Upload a file and create its database record")
 async def upload_file_endpoint(file: UploadFile = File(...)):
     try:
-        file_path = save_upload_file(file, str(UPLOAD_DIR))
-        ext = Path(file.filename).suffix.lstrip('.')
+        file_path = await save_upload_file(file, UPLOAD_DIR)
+        ext = os.path.splitext(file.filename)[1][1:].lower()
         if not ext:
             raise HTTPException(status_code=400, detail="File must have an extension.")
 
-        saved_record = save_file_record(
+        saved_record = await save_file_record(
             file_path=file_path,
             file_name=file.filename,
             file_extension=ext
@@ -47,12 +76,47 @@ async def upload_file_endpoint(file: UploadFile = File(...)):
         if saved_record is None:
             raise HTTPException(status_code=500, detail="Failed to save file record to the database.")
 
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "message": "File uploaded successfully.",
             "file_id": saved_record["file_id"],
             "file_name": file.filename,
-            "load_date": saved_record["load_date"].isoformat()
+            "load_date": saved_record["load_date"]
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
+
+
+@app.post("/files/upload_batch", summary="Upload several files and create their database records at once")
+async def upload_files_batch_endpoint(files: list[UploadFile] = File(...)):
+    try:
+        extensions = [os.path.splitext(file.filename)[1][1:].lower() for file in files]
+        if not all(extensions):
+            raise HTTPException(status_code=400, detail="Every file must have an extension.")
+        # Files are saved concurrently under their own names, so two uploads
+        # with the same name would write the same path at once.
+        if len({file.filename for file in files}) != len(files):
+            raise HTTPException(status_code=400, detail="File names within one batch must be unique.")
+
+        file_paths = await asyncio.gather(*(save_upload_file(file, UPLOAD_DIR) for file in files))
+        saved_records = await save_file_records([
+            {"file_path": file_path, "file_name": file.filename, "file_extension": ext}
+            for file, file_path, ext in zip(files, file_paths, extensions)
+        ])
+
+        if len(saved_records) != len(files):
+            raise HTTPException(status_code=500, detail="Failed to save file records to the database.")
+
+        return ORJSONResponse(content={
+            "message": "Files uploaded successfully.",
+            "files": [
+                {"file_id": record["file_id"], "file_name": file.filename, "load_date": record["load_date"]}
+                for file, record in zip(files, saved_records)
+            ]
         })
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -61,20 +125,22 @@ async def upload_file_endpoint(file: UploadFile = File(...)):
 
 @app.post("/files/{file_id}/transcribe", summary="Generate a transcript for an existing file")
 async def transcribe_file_endpoint(file_id: int = FastApiPath(..., description="The ID of the file to transcribe.")):
-    file_record = get_file_record(file_id)
+    file_record = await get_file_record(file_id)
     if not file_record:
         raise HTTPException(status_code=404, detail=f"File with ID {file_id} not found.")
 
     try:
-        extracted_text = recognize_text_from_file(file_record["file_path"])
+        loop = asyncio.get_running_loop()
+        extracted_text = await loop.run_in_executor(OCR_EXECUTOR, recognize_text_from_file, file_record["file_path"])
         
-        transcript_filename = f"{Path(file_record['file_name']).stem}_{file_id}.txt"
+        transcript_filename = f"{os.path.splitext(file_record['file_name'])[0]}_{file_id}.txt"
         transcript_path = TRANSCRIPT_DIR / transcript_filename
-        transcript_path.write_text(extracted_text, encoding="utf-8")
+        async with aiofiles.open(transcript_path, "wb") as f:
+            await f.write(extracted_text.encode("utf-8"))
 
         wer_data = {"confidence": random.uniform(0.70, 0.86), "word_count": len(extracted_text.split())}
 
-        transcript_id = save_transcript_record(
+        transcript_id = await save_transcript_record(
             file_id=file_id,
             transcript_path=str(transcript_path),
             wer=wer_data
@@ -83,7 +149,7 @@ async def transcribe_file_endpoint(file_id: int = FastApiPath(..., description="
         if transcript_id is None:
             raise HTTPException(status_code=500, detail="Failed to save transcript record.")
 
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "message": "Transcription successful.",
             "transcript_id": transcript_id,
             "file_id": file_id,
@@ -95,43 +161,77 @@ async def transcribe_file_endpoint(file_id: int = FastApiPath(..., description="
 
 @app.get("/transcripts/{transcript_id}", summary="Retrieve a specific transcript record")
 async def get_transcript_endpoint(transcript_id: int):
-    record = get_transcript_record(transcript_id)
+    record = await get_transcript_record(transcript_id)
     if not record:
         raise HTTPException(status_code=404, detail="Transcript not found.")
     return record
 
+@app.get("/transcripts/{transcript_id}/download", summary="Download the text of a transcript")
+async def download_transcript_endpoint(transcript_id: int, request: Request):
+    record = await get_transcript_record(transcript_id)
+    if not record:
+        raise HTTPException(status_code=404, detail="Transcript not found.")
+    transcript_path = Path(record["transcript_path"])
+    if TRANSCRIPT_ACCEL_PREFIX:
+        return Response(headers={
+            "X-Accel-Redirect": f"{TRANSCRIPT_ACCEL_PREFIX}/{quote(transcript_path.name)}",
+            "Content-Type": "text/plain; charset=utf-8"
+        })
+    try:
+        stat = transcript_path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Transcript file not found.")
+
+    # Edits rewrite the file, so mtime and size are enough to identify a version.
+    etag = f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=60"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(
+        transcript_path,
+        media_type="text/plain; charset=utf-8",
+        filename=transcript_path.name,
+        headers=headers,
+        stat_result=stat
+    )
+
 @app.get("/files/{file_id}/transcripts", summary="List all transcripts for a file")
 async def list_transcripts_for_file_endpoint(file_id: int):
-    transcripts = get_transcripts_for_file(file_id)
+    transcripts = await get_transcripts_for_file(file_id)
     if not transcripts:
         return {"message": "No transcripts found for this file.", "file_id": file_id, "transcripts": []}
     return {"file_id": file_id, "transcripts": transcripts}
 
+class TranscriptEdit(BaseModel):
+    text: str
+
+
 @app.post("/transcripts/{transcript_id}/edit")
-async def edit_transcript(transcript_id: int, text: str):
-    record = get_transcript_record(transcript_id)
+async def edit_transcript(transcript_id: int, edit: TranscriptEdit):
+    record = await get_transcript_record(transcript_id)
     if not record:
         raise HTTPException(status_code=404, detail="Transcript not found")
     transcript_path = record["transcript_path"]
-    # Overwrite transcript file
-    with open(transcript_path, "w", encoding="utf-8") as f:
-        f.write(text)
+    # Overwrite transcript file off the event loop
+    async with aiofiles.open(transcript_path, "wb") as f:
+        await f.write(edit.text.encode("utf-8"))
     return {"message": "Transcript updated successfully."}
 
 
 @app.get("/files/all")
 async def list_all_files():
-    files = [] 
-    for f in get_all_files():
-        transcripts = get_transcripts_for_file(f['file_id'])
-        wer = transcripts[0]['wer'] if transcripts else None
-        files.append({
-            "file_id": f['file_id'],
-            "file_name": f['file_name'],
-            "recognized": bool(transcripts),
-            "wer": wer
-        })
-    return files
+    return await get_all_files_with_latest_wer()
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # Every worker holds its own TrOCR model and DB pool, so scale workers
+    # to what the GPU memory and Postgres connection limit allow.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("API_WORKERS", "1")),
+        reload=os.getenv("API_RELOAD", "false").lower() in ("1", "true", "yes")
+    )
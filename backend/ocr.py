@@ -1,233 +1,389 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from PIL import ImageFilter, ImageEnhance, Image
-from scipy import ndimage
-from scipy.signal import find_peaks
+from PIL import Image
+import hashlib
+import multiprocessing
 import os
+import queue
+import threading
+import time
 import torch
 import numpy as np
 import cv2
 from transformers import TrOCRProcessor, VisionEncoderDecoderModel
 from pdf2image import convert_from_path
-from tqdm import tqdm
-
-
-def preprocess_for_segmentation(image):
-    print(f" preprocess_for_segmentation started")
-    enhancer = ImageEnhance.Contrast(image)
-    image = enhancer.enhance(1.2)
-    image = image.filter(ImageFilter.GaussianBlur(radius=0.3))
-    image = image.filter(ImageFilter.UnsharpMask(radius=1, percent=50, threshold=3))
-    print(f" preprocess_for_segmentation finished")
-    return image
-
-def binarize_image(image, method='sauvola'):
-    print(f" binarize_image started")
-    if image.mode != 'L':
-        grayscale_image = image.convert('L')
-    else:
-        grayscale_image = image
-    img_array = np.array(grayscale_image)
-    if method == 'otsu':
-        _, binary = cv2.threshold(img_array, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    elif method == 'adaptive':
-        binary = cv2.adaptiveThreshold(img_array, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                       cv2.THRESH_BINARY, 11, 2)
-    elif method == 'sauvola':
-        window_size = 25
-        k = 0.2
-        mean = cv2.boxFilter(img_array.astype(np.float32), -1, (window_size, window_size))
-        sqmean = cv2.boxFilter((img_array.astype(np.float32))**2, -1, (window_size, window_size))
-        variance = sqmean - mean**2
-        std = np.sqrt(variance)
-        threshold = mean * (1 + k * ((std / 128) - 1))
-        binary = np.where(img_array > threshold, 255, 0).astype(np.uint8)
+from preprocessing import preprocess_page
+
+try:
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    Levenshtein = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from diskcache import Cache
+except ImportError:
+    Cache = None
+
+# TrOCR downsizes every line to 384x384, so rendering above 300 DPI only
+# costs memory and rasterization time.
+PDF_DPI = int(os.getenv("PDF_DPI", "300"))
+
+# Page preprocessing is CPU bound and independent per page. "spawn" keeps the
+# workers free of CUDA state and of the OCR threads running in this process.
+# Half the cores are left for poppler and the recognition thread.
+def new_preprocess_pool():
+    return ProcessPoolExecutor(
+        max_workers=max(1, (os.cpu_count() or 2) // 2),
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+PREPROCESS_POOL = new_preprocess_pool()
+_preprocess_pool_lock = threading.Lock()
+
+def replace_broken_preprocess_pool(broken_pool):
+    # A worker that dies (e.g. OOM-killed on a huge page) breaks the whole
+    # executor for good. Concurrent requests see the same pool fail, so only
+    # the first one swaps in a new pool.
+    global PREPROCESS_POOL
+    with _preprocess_pool_lock:
+        if PREPROCESS_POOL is broken_pool:
+            PREPROCESS_POOL = new_preprocess_pool()
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def submit_single_file(file_path, output_folder_preprocessed, file_index=1, min_line_height=50, pool=None):
+    pool = pool or PREPROCESS_POOL
+    if file_path.suffix.lower() == '.pdf':
+        # poppler renders pages in parallel straight to disk; workers read
+        # them back one by one instead of all pages sitting in memory.
+        page_paths = convert_from_path(
+            str(file_path),
+            dpi=PDF_DPI,
+            thread_count=os.cpu_count(),
+            output_folder=str(output_folder_preprocessed),
+            # Default ppm: lossless and costs nothing to encode or decode.
+            paths_only=True
+        )
+        rendered = True
     else:
-        _, binary = cv2.threshold(img_array, 127, 255, cv2.THRESH_BINARY)
-    print(f" binarize_image finished")
-    return Image.fromarray(binary)
+        page_paths = [str(file_path)]
+        rendered = False
 
-def segment_lines_projection(image, min_line_height=10):
-    print(f"segment_lines_projection started")
-    try:
-        processed_img = preprocess_for_segmentation(image)
-        binary_img = binarize_image(processed_img, method='sauvola')
-        img_array = np.array(binary_img)
-        if np.mean(img_array) < 127:
-            img_array = 255 - img_array
-        horizontal_projection = np.sum(img_array == 0, axis=1)
-        smoothed_projection = ndimage.gaussian_filter1d(horizontal_projection, sigma=1)
-        inverted_projection = np.max(smoothed_projection) - smoothed_projection
-        gaps, _ = find_peaks(inverted_projection, height=np.max(inverted_projection) * 0.5, distance=min_line_height)
-        line_boundaries = [0] + list(gaps) + [len(horizontal_projection)]
-        for i in range(len(line_boundaries) - 1):
-            start = line_boundaries[i]
-            end = line_boundaries[i + 1]
-            region_projection = smoothed_projection[start:end]
-            if np.max(region_projection) < np.max(smoothed_projection) * 0.1:
-                continue
-            text_rows = region_projection > np.max(region_projection) * 0.1
-            text_indices = np.where(text_rows)[0]
-            if len(text_indices) == 0:
-                continue
-            actual_start = start + text_indices[0] - 2
-            actual_end = start + text_indices[-1] + 2
-            actual_start = max(0, actual_start)
-            actual_end = min(image.height, actual_end)
-            if actual_end - actual_start < min_line_height:
-                continue
-            yield (0, actual_start, image.width, actual_end)
-    except Exception as e:
-        print(f"Projection segmentation failed: {e}")
-    print(f"segment_lines_projection finished")
-
-def segment_lines(image, methods=['projection'], min_line_height=10):
-    print(f"segment_lines started")
-    if isinstance(image, (str, Path)):
-        image = Image.open(image)
-    all_line_coords = []
-    for method in methods:
-        if method == 'projection':
-            line_coords = list(segment_lines_projection(image, min_line_height))
-            if line_coords:
-                all_line_coords.extend(line_coords)
-                break
-        else:
-            print(f"Unknown method: {method}")
-            continue
-    print(f"segment_lines finished")
-    return all_line_coords
-
-def split_double_page(image: Image.Image):
-    w, h = image.size
-    mid = w // 2
-    left = image.crop((0, 0, mid, h))
-    right = image.crop((mid, 0, w, h))
-    return left, right
-
-def preprocess_image(img):
-    if img is None:
-        return None
-    if len(img.shape) == 3:
-        rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        pil_img = Image.fromarray(rgb_img)
-        return pil_img
-    else:  # Grayscale
-        gray = img.copy()
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        enhanced = clahe.apply(gray)
-        kernel = np.array([[-1,-1,-1], [-1,9,-1], [-1,-1,-1]])
-        sharpened = cv2.filter2D(enhanced, -1, kernel)
-        result = cv2.addWeighted(enhanced, 0.7, sharpened, 0.3, 0)
-        return Image.fromarray(result)
-
-def process_single_file(file_path, output_folder_preprocessed, file_index=1, min_line_height=50):
-    print(f" Processing: {file_path.name}")
-    results = []
-    try:
-        if file_path.suffix.lower() == '.pdf':
-            pages = convert_from_path(str(file_path), dpi=400)
-            for page_idx, page in enumerate(pages):
-                img = cv2.cvtColor(np.array(page), cv2.COLOR_RGB2BGR)
-                # further processing can be inserted here
-        else:
-            img = cv2.imread(str(file_path))
-            if img is None:
-                raise IOError(f"Cannot read image file: {file_path}")
-
-        processed = preprocess_image(img)
-        if processed is not None:
-            left, right = split_double_page(processed)
-            for page_img, page_side in tqdm([(left, 'left'), (right, 'right')], desc='processing_img'):
-                page_path = Path(output_folder_preprocessed) / f"{file_path.stem}_f{file_index:02d}_{page_side}.tif"
-                page_img.save(str(page_path))
-                line_coords = segment_lines(page_img, min_line_height=min_line_height)
-                if line_coords:
-                    results.append({
-                        "page_path": str(page_path),
-                        "line_coordinates": line_coords
-                    })
-                    print(f" {page_side} page: Found {len(line_coords)} lines.")
-                else:
-                    print(f" {page_side} page: No lines found.")
-    except Exception as e:
-        print(f" ERROR processing {file_path}: {e}")
-        return []
-    print(f" Processing finished: {file_path.name}")
-    return results
+    return [
+        pool.submit(
+            preprocess_page,
+            page_path,
+            output_folder_preprocessed,
+            f"{file_path.stem}_f{file_index:02d}_p{page_idx:02d}",
+            min_line_height,
+            rendered
+        )
+        for page_idx, page_path in enumerate(page_paths)
+    ]
 
 
 model_path = "trocr-base-handwritten-ru"
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+MODEL_ID = "kazars24/trocr-base-handwritten-ru"
+USE_GPU = os.getenv("USE_GPU", "true").lower() in ("1", "true", "yes")
+OCR_COMPILE = os.getenv("OCR_COMPILE", "false").lower() in ("1", "true", "yes")
+device = torch.device("cuda" if USE_GPU and torch.cuda.is_available() else "cpu")
 print(device)
-processor = TrOCRProcessor.from_pretrained('kazars24/trocr-base-handwritten-ru')
-model = VisionEncoderDecoderModel.from_pretrained('kazars24/trocr-base-handwritten-ru').to(device)
-model.eval()
-
-def predict_text_from_line_image(line_image: Image.Image):
-    print(f"predict_text_from_line_image started")
-    if line_image.mode != 'RGB':
-        line_image = line_image.convert('RGB')
-    inputs = processor(images=line_image, return_tensors="pt").to(device)
-    with torch.no_grad():
-        generated_ids = model.generate(inputs.pixel_values, max_length=128)
-    pred_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    print(f"predict_text_from_line_image finished")
-    return pred_text
-
-def process_image_with_line_coords(image_path: str, line_coords: list):
-    print(f"process_image_with_line_coords started")
+_processor = None
+_model = None
+_pinned_pixels = None
+_model_lock = threading.Lock()
+
+def get_ocr_model():
+    # Loaded on first use: preprocessing workers import this module too and
+    # must not each pay for the TrOCR weights.
+    global _processor, _model, _pinned_pixels
+    with _model_lock:
+        if _model is None:
+            # Half precision only pays off on GPU; CPU kernels for it are slower than fp32.
+            if device.type == "cuda":
+                dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            else:
+                dtype = torch.float32
+            _processor = TrOCRProcessor.from_pretrained(MODEL_ID)
+            _model = VisionEncoderDecoderModel.from_pretrained(MODEL_ID).to(device, dtype=dtype)
+            _model.eval()
+            size = _processor.image_processor.size
+            if device.type == "cuda":
+                torch.backends.cudnn.benchmark = True
+                # Page-locked staging lets batches go to the GPU with an async DMA copy.
+                _pinned_pixels = torch.empty(
+                    (LINE_BATCHER.max_batch, 3, size["height"], size["width"]),
+                    dtype=torch.float32,
+                    pin_memory=True
+                )
+            if OCR_COMPILE and device.type == "cuda":
+                compile_encoder(_processor, _model)
+            # One throwaway generate pays for kernel selection and allocator
+            # growth here rather than on the first real page.
+            with torch.inference_mode():
+                dummy = torch.zeros((1, 3, size["height"], size["width"]), device=device, dtype=_model.dtype)
+                _model.generate(dummy, max_length=8, num_beams=1, do_sample=False, use_cache=True)
+    return _processor, _model
+
+def pixels_to_device(pixel_values, dtype):
+    # The staging buffer is shared: only the LineBatcher thread runs inference.
+    batch_size = pixel_values.shape[0]
+    if _pinned_pixels is None or batch_size > _pinned_pixels.shape[0]:
+        return pixel_values.to(device, dtype=dtype)
+    staging = _pinned_pixels[:batch_size]
+    staging.copy_(pixel_values)
+    return staging.to(device, dtype=dtype, non_blocking=True)
+
+def compile_encoder(processor, model):
+    # The processor always resizes line crops to the same square input, so the
+    # encoder only ever sees a few shapes: one compiled graph per batch size.
+    model.encoder = torch.compile(model.encoder, mode="reduce-overhead")
+    size = processor.image_processor.size
+    batch_sizes = sorted({b for b in (1, 4, 8, 16) if b <= LINE_BATCHER.max_batch} | {LINE_BATCHER.max_batch})
+    with torch.inference_mode():
+        for batch_size in batch_sizes:
+            dummy = torch.zeros((batch_size, 3, size["height"], size["width"]), device=device, dtype=model.dtype)
+            model.encoder(pixel_values=dummy)
+
+# A line of handwriting never gets close to this many tokens; it only bounds runaway decoding.
+MAX_NEW_TOKENS = int(os.getenv("OCR_MAX_NEW_TOKENS", "128"))
+
+def predict_text_from_line_images(line_images: list[np.ndarray]) -> list[str]:
+    processor, model = get_ocr_model()
+    # Crops arrive already resized to the model input (see crop_line_image),
+    # so the processor only rescales and normalizes.
+    pixel_values = pixels_to_device(
+        processor(images=line_images, do_resize=False, return_tensors="pt").pixel_values,
+        model.dtype
+    )
+    with torch.inference_mode():
+        generated_ids = model.generate(
+            pixel_values,
+            max_new_tokens=MAX_NEW_TOKENS,
+            num_beams=1,
+            do_sample=False,
+            use_cache=True,
+            eos_token_id=processor.tokenizer.eos_token_id,
+            pad_token_id=processor.tokenizer.pad_token_id
+        )
+    return processor.batch_decode(generated_ids, skip_special_tokens=True)
+
+
+# Coalesces line crops from concurrent recognitions into one forward pass.
+class LineBatcher:
+    def __init__(self, max_batch=16, max_wait=0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, line_image: np.ndarray) -> Future:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ocr-batcher", daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((line_image, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                texts = predict_text_from_line_images([line_image for line_image, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), text in zip(batch, texts):
+                future.set_result(text)
+
+
+LINE_BATCHER = LineBatcher(
+    max_batch=int(os.getenv("OCR_MAX_BATCH", "16")),
+    max_wait=int(os.getenv("OCR_BATCH_WAIT_MS", "5")) / 1000
+)
+
+# Recognized text per file and per line crop: a re-uploaded scan skips the
+# whole pipeline, a rerun of an edited one only sends unseen lines to the
+# model. Empty OCR_CACHE_DIR disables it.
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "data/ocr_cache")
+# Bump when preprocessing or segmentation changes what the crops look like.
+OCR_CACHE_VERSION = 1
+_ocr_cache = None
+_ocr_cache_lock = threading.Lock()
+
+def get_ocr_cache():
+    global _ocr_cache
+    if Cache is None or not OCR_CACHE_DIR:
+        return None
+    with _ocr_cache_lock:
+        if _ocr_cache is None:
+            _ocr_cache = Cache(OCR_CACHE_DIR)
+    return _ocr_cache
+
+def file_cache_key(filepath: str) -> str:
+    hasher = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as f:
+        while chunk := f.read(1 << 20):
+            hasher.update(chunk)
+    return f"{MODEL_ID}:{OCR_CACHE_VERSION}:{MAX_NEW_TOKENS}:{PDF_DPI}:file:{hasher.hexdigest()}"
+
+def line_cache_key(line_image: np.ndarray) -> str:
+    if xxhash is not None:
+        digest = xxhash.xxh3_64_hexdigest(line_image.data)
+    else:
+        digest = hashlib.blake2b(line_image.data, digest_size=8).hexdigest()
+    return f"{MODEL_ID}:{OCR_CACHE_VERSION}:{MAX_NEW_TOKENS}:{line_image.shape}:{digest}"
+
+def submit_line(line_image: np.ndarray) -> Future:
+    cache = get_ocr_cache()
+    if cache is None:
+        return LINE_BATCHER.submit(line_image)
+    key = line_cache_key(line_image)
+    text = cache.get(key)
+    if text is not None:
+        future = Future()
+        future.set_result(text)
+        return future
+
+    def store(done):
+        if done.exception() is None:
+            cache.set(key, done.result())
+
+    future = LINE_BATCHER.submit(line_image)
+    future.add_done_callback(store)
+    return future
+
+def crop_line_image(page: np.ndarray, coords, size) -> np.ndarray:
+    x1, y1, x2, y2 = coords
+    # One area-averaging resize in OpenCV instead of PIL resampling per line
+    # inside the processor.
+    line = cv2.resize(page[y1:y2, x1:x2], (size["width"], size["height"]), interpolation=cv2.INTER_AREA)
+    return line if line.ndim == 3 else cv2.cvtColor(line, cv2.COLOR_GRAY2RGB)
+
+def line_ink_extents(page: np.ndarray, line_coords: list) -> list[int]:
+    # Every line box spans the full page width, so the number of columns
+    # holding ink is what tells how much text a line carries.
+    gray = page if page.ndim == 2 else cv2.cvtColor(page, cv2.COLOR_RGB2GRAY)
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return [
+        cv2.countNonZero(cv2.reduce(ink[y1:y2, x1:x2], 0, cv2.REDUCE_MAX))
+        for x1, y1, x2, y2 in line_coords
+    ]
+
+def submit_page_lines(image_path: str, line_coords: list):
     try:
-        page_image = Image.open(image_path)
+        page_image = np.asarray(Image.open(image_path))
     except IOError:
         print(f"Could not open image file: {image_path}")
-        return "", []
+        return []
+    size = get_ocr_model()[0].image_processor.size
+    # Queue the whole page up front so its lines share batched forward passes.
+    # A batch decodes until its longest line emits EOS, so lines are queued
+    # from shortest to longest text: neighbours in a batch finish together.
+    # Results are returned in page order.
+    extents = line_ink_extents(page_image, line_coords)
+    order = sorted(range(len(line_coords)), key=extents.__getitem__)
+    futures = [None] * len(line_coords)
+    for i in order:
+        futures[i] = submit_line(crop_line_image(page_image, line_coords[i], size))
+    return list(zip(line_coords, futures))
+
+def collect_page_lines(line_futures: list):
     all_line_data = []
     full_text = []
-    for coords in line_coords:
-        line_image = page_image.crop(coords)
-        line_text = predict_text_from_line_image(line_image)
+    for coords, future in line_futures:
+        line_text = future.result()
         if line_text:
             full_text.append(line_text)
             all_line_data.append({"text": line_text, "coords": coords})
-    print(f"process_image_with_line_coords finished")
     return "\n".join(full_text), all_line_data
 
 def recognize_text_from_file(filepath: str) -> str:
     print(f"recognize_text_from_file started for {filepath}")
+    cache = get_ocr_cache()
+    cache_key = None
     # Create a temporary output folder for preprocessed files
     output_folder = Path("data/preprocessed") / Path(filepath).stem
     output_folder.mkdir(parents=True, exist_ok=True)
-    pages_with_coords = process_single_file(Path(filepath), output_folder, file_index=0, min_line_height=50)
-    if not pages_with_coords:
-        print("No text lines detected for recognition.")
+    pool = PREPROCESS_POOL
+    try:
+        if cache is not None:
+            cache_key = file_cache_key(filepath)
+            cached_text = cache.get(cache_key)
+            if cached_text is not None:
+                print(f"recognize_text_from_file served {filepath} from cache")
+                return cached_text
+        page_futures = submit_single_file(Path(filepath), output_folder, file_index=0, min_line_height=50, pool=pool)
+        # Each page's lines go to the recognition batcher as soon as the page is
+        # segmented, while the pool is still preprocessing the following pages.
+        pages = [
+            submit_page_lines(page_data["page_path"], page_data["line_coordinates"])
+            for future in page_futures
+            for page_data in future.result()
+        ]
+    except BrokenProcessPool:
+        # Not an empty document: the request fails, later ones get a new pool.
+        print(f" ERROR processing {filepath}: preprocessing pool broke, replacing it")
+        replace_broken_preprocess_pool(pool)
+        raise
+    except Exception as e:
+        # Failures are not cached, the next request tries again.
+        print(f" ERROR processing {filepath}: {e}")
         return ""
-    full_texts = []
-    for page_data in pages_with_coords:
-        page_path = page_data["page_path"]
-        line_coords = page_data["line_coordinates"]
-        full_text, _ = process_image_with_line_coords(page_path, line_coords)
-        full_texts.append(full_text)
-    result_text = "\n\n".join(full_texts)
+    if not pages:
+        print("No text lines detected for recognition.")
+        result_text = ""
+    else:
+        full_texts = [collect_page_lines(line_futures)[0] for line_futures in pages]
+        result_text = "\n\n".join(full_texts)
+    # An empty result can come from a segmentation failure that was only
+    # logged, so it is recognized again next time rather than cached.
+    if cache_key is not None and result_text:
+        cache.set(cache_key, result_text)
     print(f"recognize_text_from_file finished")
     return result_text
 
 def wer(reference, hypothesis):
     r, h = reference.split(), hypothesis.split()
-    import numpy as np
-    d = np.zeros([len(r)+1, len(h)+1], dtype=np.uint32)
-    for i in range(len(r)+1):
-        d[i][0] = i
-    for j in range(len(h)+1):
-        d[0][j] = j
-    for i in range(1, len(r)+1):
-        for j in range(1, len(h)+1):
-            if r[i-1] == h[j-1]:
-                d[i][j] = d[i-1][j-1]
-            else:
-                substitution = d[i-1][j-1] + 1
-                insertion    = d[i][j-1] + 1
-                deletion     = d[i-1][j] + 1
-                d[i][j] = min(substitution, insertion, deletion)
-    wer_value = d[len(r)][len(h)] / max(1, len(r))
+    if Levenshtein is not None:
+        return Levenshtein.distance(r, h) / max(1, len(r))
+    # Two rolling rows over the shorter sequence instead of the full matrix.
+    # Words become integer ids so a whole row is compared at once.
+    vocab = {}
+    r_ids = np.array([vocab.setdefault(w, len(vocab)) for w in r], dtype=np.int64)
+    h_ids = np.array([vocab.setdefault(w, len(vocab)) for w in h], dtype=np.int64)
+    outer, inner = (r_ids, h_ids) if len(r_ids) >= len(h_ids) else (h_ids, r_ids)
+    offsets = np.arange(len(inner) + 1, dtype=np.int64)
+    prev = offsets.copy()
+    for i, token in enumerate(outer, start=1):
+        curr = np.empty_like(prev)
+        curr[0] = i
+        # Substitution and deletion only depend on the previous row...
+        curr[1:] = np.minimum(prev[:-1] + (inner != token), prev[1:] + 1)
+        # ...insertions chain along the row: curr[j] = min_k(curr[k] + j - k).
+        prev = np.minimum.accumulate(curr - offsets) + offsets
+    wer_value = prev[-1] / max(1, len(r))
     return wer_value
 
@@ -0,0 +1,139 @@
+from pathlib import Path
+import os
+from PIL import ImageFilter, ImageEnhance, Image
+from scipy import ndimage
+from scipy.signal import find_peaks
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+
+def preprocess_for_segmentation(image):
+    print(f" preprocess_for_segmentation started")
+    enhancer = ImageEnhance.Contrast(image)
+    image = enhancer.enhance(1.2)
+    image = image.filter(ImageFilter.GaussianBlur(radius=0.3))
+    image = image.filter(ImageFilter.UnsharpMask(radius=1, percent=50, threshold=3))
+    print(f" preprocess_for_segmentation finished")
+    return image
+
+def binarize_image(image, method='sauvola'):
+    print(f" binarize_image started")
+    if image.mode != 'L':
+        grayscale_image = image.convert('L')
+    else:
+        grayscale_image = image
+    img_array = np.asarray(grayscale_image)
+    if method == 'otsu':
+        _, binary = cv2.threshold(img_array, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    elif method == 'adaptive':
+        binary = cv2.adaptiveThreshold(img_array, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                       cv2.THRESH_BINARY, 11, 2)
+    elif method == 'sauvola':
+        window_size = 25
+        k = 0.2
+        pixels = img_array.astype(np.float32)
+        mean = cv2.boxFilter(pixels, -1, (window_size, window_size))
+        sqmean = cv2.sqrBoxFilter(pixels, cv2.CV_32F, (window_size, window_size))
+        std = cv2.sqrt(cv2.subtract(sqmean, cv2.multiply(mean, mean)))
+        # mean * (1 + k * (std / 128 - 1)), kept in OpenCV's vectorized kernels
+        threshold = cv2.multiply(mean, cv2.addWeighted(std, k / 128, std, 0, 1 - k))
+        binary = cv2.compare(pixels, threshold, cv2.CMP_GT)
+    else:
+        _, binary = cv2.threshold(img_array, 127, 255, cv2.THRESH_BINARY)
+    print(f" binarize_image finished")
+    return binary
+
+def segment_lines_projection(image: np.ndarray, min_line_height=10):
+    print(f"segment_lines_projection started")
+    try:
+        height, width = image.shape[:2]
+        # The PIL filters below are the only stage that needs an Image.
+        processed_img = preprocess_for_segmentation(Image.fromarray(image))
+        img_array = binarize_image(processed_img, method='sauvola')
+        if np.mean(img_array) < 127:
+            img_array = 255 - img_array
+        horizontal_projection = np.sum(img_array == 0, axis=1)
+        smoothed_projection = ndimage.gaussian_filter1d(horizontal_projection, sigma=1)
+        inverted_projection = np.max(smoothed_projection) - smoothed_projection
+        gaps, _ = find_peaks(inverted_projection, height=np.max(inverted_projection) * 0.5, distance=min_line_height)
+        # Every region between two gaps is handled at once: per-region maxima
+        # via reduceat, then the first/last text row of each region by
+        # searching the sorted indices of all rows above their region's cutoff.
+        line_boundaries = np.concatenate(([0], gaps, [len(horizontal_projection)]))
+        starts, ends = line_boundaries[:-1], line_boundaries[1:]
+        region_max = np.maximum.reduceat(smoothed_projection, starts)
+        row_cutoff = np.repeat(region_max * 0.1, ends - starts)
+        text_rows = np.flatnonzero(smoothed_projection > row_cutoff)
+        first = np.searchsorted(text_rows, starts)
+        last = np.searchsorted(text_rows, ends) - 1
+        keep = (region_max >= np.max(smoothed_projection) * 0.1) & (first <= last)
+        actual_start = np.maximum(0, text_rows[first[keep]] - 2)
+        actual_end = np.minimum(height, text_rows[last[keep]] + 2)
+        tall_enough = actual_end - actual_start >= min_line_height
+        yield from ((0, int(top), width, int(bottom))
+                    for top, bottom in zip(actual_start[tall_enough], actual_end[tall_enough]))
+    except Exception as e:
+        print(f"Projection segmentation failed: {e}")
+    print(f"segment_lines_projection finished")
+
+def segment_lines(image, methods=['projection'], min_line_height=10):
+    print(f"segment_lines started")
+    if isinstance(image, (str, Path)):
+        image = np.asarray(Image.open(image))
+    all_line_coords = []
+    for method in methods:
+        if method == 'projection':
+            line_coords = list(segment_lines_projection(image, min_line_height))
+            if line_coords:
+                all_line_coords.extend(line_coords)
+                break
+        else:
+            print(f"Unknown method: {method}")
+            continue
+    print(f"segment_lines finished")
+    return all_line_coords
+
+def split_double_page(image: np.ndarray):
+    # Views into the page, nothing is copied.
+    mid = image.shape[1] // 2
+    return image[:, :mid], image[:, mid:]
+
+def preprocess_image(img):
+    if img is None:
+        return None
+    if len(img.shape) == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    else:  # Grayscale
+        gray = img.copy()
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+        enhanced = clahe.apply(gray)
+        kernel = np.array([[-1,-1,-1], [-1,9,-1], [-1,-1,-1]])
+        sharpened = cv2.filter2D(enhanced, -1, kernel)
+        return cv2.addWeighted(enhanced, 0.7, sharpened, 0.3, 0)
+
+def preprocess_page(page_path, output_folder_preprocessed, page_stem, min_line_height=50, remove_source=False):
+    img = cv2.imread(str(page_path))
+    if img is None:
+        raise IOError(f"Cannot read image file: {page_path}")
+    if remove_source:
+        os.remove(page_path)
+    results = []
+    processed = preprocess_image(img)
+    if processed is not None:
+        left, right = split_double_page(processed)
+        for page_img, page_side in tqdm([(left, 'left'), (right, 'right')], desc='processing_img'):
+            # Lossless like the old uncompressed TIFF, at a fraction of the
+            # bytes written; level 1 keeps the deflate cost low.
+            page_path = Path(output_folder_preprocessed) / f"{page_stem}_{page_side}.png"
+            Image.fromarray(page_img).save(str(page_path), compress_level=1)
+            line_coords = segment_lines(page_img, min_line_height=min_line_height)
+            if line_coords:
+                results.append({
+                    "page_path": str(page_path),
+                    "line_coordinates": line_coords
+                })
+                print(f" {page_side} page: Found {len(line_coords)} lines.")
+            else:
+                print(f" {page_side} page: No lines found.")
+    return results
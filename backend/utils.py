@@ -1,16 +1,52 @@
+import aiofiles
+import orjson
 import os
 import shutil
+from pathlib import Path
 from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 
-def save_upload_file(upload_file: UploadFile, destination_folder: str) -> str:
+UPLOAD_CHUNK_SIZE = 1 << 22
+
+def copy_spooled_file(source, filepath: str):
+    source.seek(0)
+    with open(filepath, "wb") as buffer:
+        if hasattr(os, "copy_file_range"):
+            # Kernel-side copy between the two descriptors, no userspace buffers.
+            src_fd, dst_fd = source.fileno(), buffer.fileno()
+            try:
+                while os.copy_file_range(src_fd, dst_fd, UPLOAD_CHUNK_SIZE):
+                    pass
+                return
+            except OSError:
+                # e.g. EXDEV on older kernels: restart with a plain copy.
+                source.seek(0)
+                buffer.seek(0)
+                buffer.truncate()
+        shutil.copyfileobj(source, buffer, UPLOAD_CHUNK_SIZE)
+
+async def save_upload_file(upload_file: UploadFile, destination_folder: Path) -> str:
     try:
-        os.makedirs(destination_folder, exist_ok=True)
-        
-        filepath = os.path.join(destination_folder, upload_file.filename)
-        
-        with open(filepath, "wb") as buffer:
-            shutil.copyfileobj(upload_file.file, buffer)
+        # The destination is created once at startup by the caller.
+        filepath = str(destination_folder / upload_file.filename)
+
+        # Large uploads are already spooled to a temp file on disk by the
+        # multipart parser; copy that file descriptor to descriptor.
+        if getattr(upload_file.file, "_rolled", False):
+            await run_in_threadpool(copy_spooled_file, upload_file.file, filepath)
+            return filepath
+
+        # Copy in bounded chunks so large scans never sit in memory at once.
+        async with aiofiles.open(filepath, "wb") as buffer:
+            while chunk := await upload_file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
             
         return filepath
     finally:
-        upload_file.file.close()
+        await upload_file.close()
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
@@ -1,12 +1,21 @@
 import streamlit as st
 import os
-import shutil
-import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
 from PIL import Image
+from pdf2image import convert_from_bytes
+import time
 import requests
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+import csv
+import hashlib
+import io
 
 # --- Configuration ---
+# Resolved once per server process: the script (and any lru_cache in it) is
+# re-executed on every rerun, st.cache_resource survives reruns.
+@st.cache_resource
 def get_api_base_url():
     # 1. Check for Docker/CI environment variable
     env_url = os.environ.get("API_BASE_URL")
@@ -23,7 +32,63 @@ def get_api_base_url():
     return "http://127.0.0.1:8000"
 
 API_BASE = get_api_base_url()
-TEMP_DIR = "temp_uploads"
+# Files are uploaded and transcribed concurrently, a few at a time.
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "4"))
+# Uploads are grouped into multipart requests of this many files or bytes.
+UPLOAD_BATCH_FILES = 20
+UPLOAD_BATCH_BYTES = 20 << 20
+PREVIEW_SIZE = (1024, 1024)
+# Upper bound on progress bar redraws per run, however many files there are.
+PROGRESS_UPDATES = 100
+# Uploads refused by the backend or its proxy are retried this many times,
+# after 1 s, 2 s, ... A 504 is not retried: the request may still be running.
+RETRY_STATUSES = {502, 503}
+RETRY_ATTEMPTS = 1
+RETRY_BACKOFF = 1.0
+# (connect, read) seconds; recognition of a long PDF has no upper bound.
+API_TIMEOUT = (3, 60)
+TRANSCRIBE_TIMEOUT = (3, None)
+
+@st.cache_resource
+def get_session():
+    # One keep-alive pool shared by all reruns and upload threads.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def parse_json(response):
+    # orjson parses the raw bytes directly, without requests' text decoding.
+    return orjson.loads(response.content)
+
+# Every widget interaction reruns the script; the document list only needs
+# to be fetched again after an upload or once it is 30 s old.
+@st.cache_data(ttl=30)
+def fetch_all_files():
+    response = get_session().get(f"{API_BASE}/files/all", timeout=API_TIMEOUT)
+    response.raise_for_status()
+    return parse_json(response)
+
+# Previews are decoded once per file at reduced size; JPEG draft mode lets
+# libjpeg skip most of the full-resolution decode, PDFs only have their first
+# page rendered by poppler straight at preview size. Only recent files are kept.
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_preview(file_id, _upload_obj):
+    _upload_obj.seek(0)
+    if _upload_obj.name.lower().endswith(".pdf"):
+        img = convert_from_bytes(_upload_obj.read(), first_page=1, last_page=1, size=max(PREVIEW_SIZE))[0]
+    else:
+        img = Image.open(_upload_obj)
+        img.draft("RGB", PREVIEW_SIZE)
+    img.thumbnail(PREVIEW_SIZE, Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    img.convert("RGB").save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def content_digest(upload_obj):
+    # getbuffer() hashes the uploaded bytes in place, without a copy.
+    return hashlib.blake2b(upload_obj.getbuffer(), digest_size=16).hexdigest()
 
 def initialize_session_state():
     """Initializes session state variables."""
@@ -44,9 +109,138 @@ def progress_message(value):
     else:
         return "Сделано!"
 
+def upload_batches(files):
+    # Several files per multipart request, bounded by count and total size.
+    # The backend rejects a batch with repeated names, so a name that is
+    # already in the batch starts the next one.
+    batch, batch_bytes, batch_names = [], 0, set()
+    for file_info in files:
+        size = file_info["upload_obj"].size
+        if batch and (
+            len(batch) == UPLOAD_BATCH_FILES
+            or batch_bytes + size > UPLOAD_BATCH_BYTES
+            or file_info["name"] in batch_names
+        ):
+            yield batch
+            batch, batch_bytes, batch_names = [], 0, set()
+        batch.append(file_info)
+        batch_bytes += size
+        batch_names.add(file_info["name"])
+    if batch:
+        yield batch
+
+class UploadStream:
+    # MultipartEncoder copies anything with getvalue(), which includes
+    # Streamlit's UploadedFile, into a buffer of its own. Through this
+    # wrapper it reads the upload in chunks while the request is sent.
+    def __init__(self, upload_obj):
+        self._upload_obj = upload_obj
+        upload_obj.seek(0)
+
+    @property
+    def len(self):
+        # Bytes left to send, as the encoder expects.
+        return self._upload_obj.size - self._upload_obj.tell()
+
+    def read(self, size=-1):
+        return self._upload_obj.read(size)
+
+def post_with_retry(session, url, timeout, fields):
+    # 502/503 from the backend or a proxy in front of it are usually
+    # transient. Requests made from the worker threads back off there while
+    # the other files keep going. Only uploads go through here: a repeated
+    # transcription would run OCR and store a transcript a second time.
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        # The encoder can only be sent once, so every attempt gets a new one
+        # over freshly rewound files. It writes the files into the request
+        # body chunk by chunk instead of assembling it in memory.
+        payload = MultipartEncoder(fields=[
+            (field, (file_name, UploadStream(upload_obj), content_type))
+            for field, (file_name, upload_obj, content_type) in fields
+        ])
+        response = session.post(
+            url,
+            data=payload,
+            headers={"Content-Type": payload.content_type},
+            timeout=timeout
+        )
+        if response.status_code not in RETRY_STATUSES or attempt == RETRY_ATTEMPTS:
+            return response
+        time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+def upload_batch(session, batch):
+    # Returns (file_ids, error); both are None if the backend has no batch endpoint.
+    response = post_with_retry(
+        session,
+        f"{API_BASE}/files/upload_batch",
+        API_TIMEOUT,
+        fields=[("files", (file_info["name"], file_info["upload_obj"], "application/octet-stream")) for file_info in batch]
+    )
+    if response.status_code in (404, 405):
+        return None, None
+    if response.status_code != 200:
+        names = ", ".join(f"'{file_info['name']}'" for file_info in batch)
+        return None, f"Ошибка загрузки {names}: {response.status_code} - {response.text}"
+    return [uploaded["file_id"] for uploaded in parse_json(response)["files"]], None
+
+def upload_file(session, file_info):
+    file_name = file_info["name"]
+    upload_response = post_with_retry(
+        session,
+        f"{API_BASE}/files/upload",
+        API_TIMEOUT,
+        fields=[("file", (file_name, file_info["upload_obj"], "application/octet-stream"))]
+    )
+    if upload_response.status_code != 200:
+        return None, f"Ошибка загрузки '{file_name}': {upload_response.status_code} - {upload_response.text}"
+    return parse_json(upload_response).get("file_id"), None
+
+def transcribe_file(session, file_info, file_id):
+    # Runs in a worker thread, so it only talks to the API; all st.* calls
+    # stay in the script thread.
+    file_name = file_info["name"]
+    transcribe_response = session.post(f"{API_BASE}/files/{file_id}/transcribe", timeout=TRANSCRIBE_TIMEOUT)
+    if transcribe_response.status_code != 200:
+        return None, f"Ошибка распознавания текста '{file_name}': {transcribe_response.status_code} - {transcribe_response.text}"
+
+    transcribe_data = parse_json(transcribe_response)
+    return {
+        "text": transcribe_data.get("text", ""),
+        "upload_obj": file_info["upload_obj"],
+        "file_id": file_id,
+        "transcript_id": transcribe_data.get("transcript_id"),
+    }, None
+
+def process_file(session, file_info):
+    file_id, error = upload_file(session, file_info)
+    if error:
+        return None, error
+    return transcribe_file(session, file_info, file_id)
+
+def export_json(records) -> bytes:
+    return orjson.dumps(records, option=orjson.OPT_INDENT_2)
+
+def export_csv(records) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    writer.writerow(["filename", "text"])
+    writer.writerows((item["filename"], item["text"]) for item in records)
+    return buffer.getvalue().encode("utf-8")
+
+def export_txt(records) -> bytes:
+    buffer = io.StringIO()
+    buffer.writelines(f"--- File: {item['filename']} ---\n{item['text']}\n\n" for item in records)
+    return buffer.getvalue().encode("utf-8")
+
+# Export format -> (encoder, MIME type, file extension).
+EXPORT_FORMATS = {
+    "JSON": (export_json, "application/json", ".json"),
+    "CSV": (export_csv, "text/csv", ".csv"),
+    "TXT": (export_txt, "text/plain", ".txt"),
+}
+
 st.title("Archive Vision - Сервис оцифровки архивных документов")
 
-os.makedirs(TEMP_DIR, exist_ok=True)
 initialize_session_state()
 
 files_to_process = []
@@ -63,11 +257,18 @@ if input_method == "Загрузить документы":
         accept_multiple_files=True
     )
     if uploaded_files:
+        # Uploaded files are already held by Streamlit; they are sent and
+        # previewed from there without a copy in a temp directory.
+        # Files from different folders can share a name; later ones get a
+        # numbered name so results and widgets are not mixed up.
+        name_counts = {}
         for uf in uploaded_files:
-            path = os.path.join(TEMP_DIR, uf.name)
-            with open(path, "wb") as f:
-                f.write(uf.getvalue())
-            files_to_process.append({"name": uf.name, "path": path, "upload_obj": uf})
+            name_counts[uf.name] = name_counts.get(uf.name, 0) + 1
+            name = uf.name
+            if name_counts[uf.name] > 1:
+                stem, ext = os.path.splitext(uf.name)
+                name = f"{stem} ({name_counts[uf.name]}){ext}"
+            files_to_process.append({"name": name, "upload_obj": uf})
 
 if files_to_process:
     st.write(f"Найдено {len(files_to_process)} файлов для обработки.")
@@ -75,50 +276,87 @@ if files_to_process:
 
     if st.button("Начать обработку", type="primary"):
         progress_bar = st.progress(0)
+        # One collapsible panel collects the per-file messages.
+        status = st.status("Обработка документов...", expanded=True)
+        log = status.container()
         st.session_state.processed_files = {} 
         
-        for i, file_info in enumerate(files_to_process):
-            file_name = file_info["name"]
-            file_path = file_info["path"]
-            
-            try:
-                with open(file_path, "rb") as f:
-                    files_payload = {"file": (file_name, f, "application/octet-stream")}
-                    upload_response = requests.post(f"{API_BASE}/files/upload", files=files_payload)
-
-                if upload_response.status_code == 200:
-                    upload_data = upload_response.json()
-                    file_id = upload_data.get("file_id")
-                    st.info(f"'{file_name}' успешно загружен. File ID: {file_id}")
-
-                    transcribe_url = f"{API_BASE}/files/{file_id}/transcribe"
-                    transcribe_response = requests.post(transcribe_url)
-                    
-                    if transcribe_response.status_code == 200:
-                        transcribe_data = transcribe_response.json()
-                        extracted_text = transcribe_data.get("text", "")
-                        transcript_id = transcribe_data.get("transcript_id")
-                        
-                        st.session_state.processed_files[file_name] = {
-                            "text": extracted_text,
-                            "path": file_path,
-                            "file_id": file_id,
-                            "transcript_id": transcript_id,
-                        }
-                        st.success(f"'{file_name}' успешно распознан.")
-                    else:
-                        st.error(f"Ошибка распознавания текста '{file_name}': {transcribe_response.status_code} - {transcribe_response.text}")
+        # Identical scans are uploaded and recognized once; every copy
+        # gets the same result. Digests are kept per upload, not per name.
+        unique_files = {}
+        for file_info in files_to_process:
+            file_info["digest"] = content_digest(file_info["upload_obj"])
+            unique_files.setdefault(file_info["digest"], file_info)
+        unique_files = list(unique_files.values())
+        if len(unique_files) < len(files_to_process):
+            log.write(f"Одинаковых файлов пропущено: {len(files_to_process) - len(unique_files)}")
+
+        results = {}
+        progress_step = max(1, len(unique_files) // PROGRESS_UPDATES)
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            session = get_session()
+            futures = {}
+            failed = 0
+            # Batches are uploaded one after another while the files of the
+            # previous batches are already being transcribed.
+            for batch in upload_batches(unique_files):
+                try:
+                    file_ids, error = upload_batch(session, batch)
+                except Exception as e:
+                    file_ids, error = None, f"Произошла непредвиденная ошибка при загрузке: {e}"
+                if error:
+                    log.write(f"✗ {error}")
+                    failed += len(batch)
+                    progress_bar.progress(failed / len(unique_files))
+                elif file_ids is None:
+                    # Backend without /files/upload_batch: one upload per file.
+                    futures.update({executor.submit(process_file, session, file_info): file_info for file_info in batch})
                 else:
-                    st.error(f"Ошибка загрузки '{file_name}': {upload_response.status_code} - {upload_response.text}")
+                    futures.update({
+                        executor.submit(transcribe_file, session, file_info, file_id): file_info
+                        for file_info, file_id in zip(batch, file_ids)
+                    })
+            for i, future in enumerate(as_completed(futures), start=failed):
+                file_name = futures[future]["name"]
+                try:
+                    result, error = future.result()
+                    if result is not None:
+                        results[futures[future]["digest"]] = result
+                        log.write(f"✓ '{file_name}' успешно загружен и распознан. File ID: {result['file_id']}")
+                    else:
+                        log.write(f"✗ {error}")
+                except Exception as e:
+                    log.write(f"✗ Произошла непредвиденная ошибка с '{file_name}': {e}")
 
-            except Exception as e:
-                st.error(f"Произошла непредвиденная ошибка с '{file_name}': {e}")
-            
-            progress = (i + 1) / len(files_to_process)
-            progress_bar.progress(progress)
-            st.write(progress_message(progress))
+                if (i + 1) % progress_step == 0 or i + 1 == len(unique_files):
+                    progress = (i + 1) / len(unique_files)
+                    progress_bar.progress(progress, text=progress_message(progress))
 
-        st.session_state.total_processed_count = len(st.session_state.processed_files)
+        # Files finish in any order; list them in the order they were uploaded.
+        # Copies share one transcript, so they get one editor under the first
+        # name and are listed there instead of getting editors of their own.
+        processed_files = {}
+        first_names = {}
+        for file_info in files_to_process:
+            digest = file_info["digest"]
+            if digest not in results:
+                continue
+            if digest in first_names:
+                processed_files[first_names[digest]]["duplicates"].append(file_info["name"])
+            else:
+                first_names[digest] = file_info["name"]
+                processed_files[file_info["name"]] = {**results[digest], "duplicates": []}
+        st.session_state.processed_files = processed_files
+        st.session_state.total_processed_count = sum(
+            1 + len(data["duplicates"]) for data in processed_files.values()
+        )
+        all_succeeded = st.session_state.total_processed_count == len(files_to_process)
+        status.update(
+            label="Готово" if all_succeeded else "Готово, с ошибками",
+            state="complete" if all_succeeded else "error",
+            expanded=not all_succeeded
+        )
+        fetch_all_files.clear()
         st.balloons()
         st.subheader("Обработка завершена!")
         st.write(f"Загруженные файлы: {st.session_state.total_session_files}")
@@ -127,16 +365,16 @@ if files_to_process:
 if st.session_state.processed_files:
     st.header("Посмотреть и отредактировать распознанный текст")
     for name, data in st.session_state.processed_files.items():
-        with st.expander(f"**{name}** (File ID: {data['file_id']}, Transcript ID: {data['transcript_id']})"):
+        title = f"**{name}** (File ID: {data['file_id']}, Transcript ID: {data['transcript_id']})"
+        if data["duplicates"]:
+            title += f", копии: {', '.join(data['duplicates'])}"
+        with st.expander(title):
             col1, col2 = st.columns(2)
             
             with col1:
                 try:
-                    if data["path"].lower().endswith('.pdf'):
-                        st.info("PDF картинка недоступна.")
-                    else:
-                        img = Image.open(data["path"])
-                        st.image(img, caption="Картинка", use_container_width=True)
+                    caption = "Первая страница" if name.lower().endswith('.pdf') else "Картинка"
+                    st.image(load_preview(data["file_id"], data["upload_obj"]), caption=caption, use_container_width=True)
                 except Exception as e:
                     st.warning(f"Не получилось загрузить картинку для: {name}. Ошибка: {e}")
 
@@ -147,13 +385,19 @@ if st.session_state.processed_files:
                     height=300,
                     key=f"text_{name}"
                 )
-                
-                if edited_text != data["text"]:
-                    st.session_state.processed_files[name]["text"] = edited_text
+
+                # Edits are sent once, on an explicit save, not on every rerun.
+                if st.button("Сохранить", key=f"save_{name}", disabled=edited_text == data["text"]):
                     transcript_id = data["transcript_id"]
-                    api_url = f"{get_api_base_url()}/transcripts/{transcript_id}/edit"
-                    response = requests.post(api_url, json={"text": edited_text})
+                    api_url = f"{API_BASE}/transcripts/{transcript_id}/edit"
+                    response = get_session().post(
+                        api_url,
+                        data=orjson.dumps({"text": edited_text}),
+                        headers={"Content-Type": "application/json"},
+                        timeout=API_TIMEOUT
+                    )
                     if response.status_code == 200:
+                        st.session_state.processed_files[name]["text"] = edited_text
                         st.info("Изменения в распознании сохранены.")
                     else:
                         st.error("Не получилось обновить файл с транскрипциями: " + response.text)
@@ -161,59 +405,35 @@ if st.session_state.processed_files:
 if st.session_state.processed_files:
     st.header("Экспорт данных")
     
-    export_format = st.selectbox("Выберете формат:", ("JSON", "CSV", "TXT"))
+    export_format = st.selectbox("Выберете формат:", tuple(EXPORT_FORMATS))
 
     if st.button("Экспорт данных"):
         export_data_list = []
         for name, data in st.session_state.processed_files.items():
-            export_data_list.append({
-                "filename": name,
+            export_data_list.extend({
+                "filename": filename,
                 "file_id": data["file_id"],
                 "transcript_id": data["transcript_id"],
                 "text": data["text"]
-            })
-
-        if export_format == "JSON":
-            export_str = json.dumps(export_data_list, ensure_ascii=False, indent=4)
-            mime = "application/json"
-            file_ext = ".json"
-        elif export_format == "CSV":
-            csv_lines = ['"filename","text"']
-            for item in export_data_list:
-                text_escaped = item['text'].replace('"', '""')
-                csv_lines.append(f'"{item["filename"]}","{text_escaped}"')
-            export_str = "\n".join(csv_lines)
-            mime = "text/csv"
-            file_ext = ".csv"
-        else:
-            txt_lines = []
-            for item in export_data_list:
-                txt_lines.append(f"--- File: {item['filename']} ---\n{item['text']}\n")
-            export_str = "\n".join(txt_lines)
-            mime = "text/plain"
-            file_ext = ".txt"
+            } for filename in (name, *data["duplicates"]))
+
+        encode, mime, file_ext = EXPORT_FORMATS[export_format]
+        export_bytes = encode(export_data_list)
 
         st.download_button(
             label="Скачать данные",
-            data=export_str,
+            data=export_bytes,
             file_name=f"archive_export{file_ext}",
             mime=mime,
         )
 
-response = requests.get(f"{get_api_base_url()}/files/all")
-if response.status_code == 200:
-    files = response.json()
-    count = len(files)
-else:
+try:
+    files = fetch_all_files()
+    st.write(f"Общее количество обработанных документов: {len(files)}")
+except requests.RequestException:
     st.error("Не получилось загрузить документы.")
 
-st.write(f"Общее количество обработанных документов: {count}")
-
 if st.button("Очистить данные текущей сессии"):
-    try:
-        shutil.rmtree(TEMP_DIR)
-    except Exception as e:
-        st.error(f"Не получилось удалить временную директорию: {e}")
     st.session_state.clear()
     st.success("Данные очищены. Перезгрузите страницу.")
     st.rerun()
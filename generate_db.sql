@@ -11,4 +11,6 @@ CREATE TABLE file_transcripts (
     transcript_path TEXT NOT NULL,   -- путь до расшифровки
     wer JSONB,                       -- JSON с уверенностью по словам
     created_at TIMESTAMP DEFAULT now()
-);
\ No newline at end of file
+);
+-- ускоряет выборку последних расшифровок файла; на существующей БД создавать через CREATE INDEX CONCURRENTLY
+CREATE INDEX ix_file_transcripts_file_id_created_at ON file_transcripts (file_id, created_at DESC);
\ No newline at end of file